@@ -1,88 +1,399 @@
-from groq import Groq
-from dotenv import load_dotenv
-from typing import Optional, List, Generator
-import os
-
-load_dotenv()
-
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
-if not GROQ_API_KEY:
-    raise ValueError("Please set the GROQ_API_KEY environment variable in .env file")
-
-# Initialize Groq client
-client = Groq(api_key=GROQ_API_KEY)
-
-SYSTEM = """
-You are Sana, a friendly and natural voice assistant.
-
-Style:
-- Speak clearly and casually, like a normal person.
-- Be polite, warm, and helpful.
-- Avoid sarcasm, teasing, roleplay, and dramatic expressions.
-- Keep responses short and easy to speak aloud.
-- Use simple words and short sentences when possible.
-
-Behavior:
-- Answer directly first, then add a brief follow-up question only if helpful.
-- If the user sounds emotional, respond gently.
-- Do not mention being an AI unless explicitly asked.
-
-Address the user as "karthick" when natural.
-"""
-
-
-def ask_llm(text: str, memory: Optional[List] = None) -> str:
-    """Non-streaming version for compatibility."""
-    messages = _build_messages(text, memory)
-
-    response = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=messages,
-        temperature=0.5,
-        max_tokens=160,  # Keep spoken replies concise
-        top_p=0.9,
-        stream=False,
-    )
-
-    return response.choices[0].message.content
-
-
-def ask_llm_stream(text: str, memory: Optional[List] = None) -> Generator[str, None, None]:
-    """Streaming version - yields text chunks as they arrive."""
-    messages = _build_messages(text, memory)
-
-    stream = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=messages,
-        temperature=0.5,
-        max_tokens=160,
-        top_p=0.9,
-        stream=True,
-    )
-
-    for chunk in stream:
-        if chunk.choices[0].delta.content:
-            yield chunk.choices[0].delta.content
-
-
-def _build_messages(text: str, memory: Optional[List] = None) -> list:
-    """Build message array for API call."""
-    messages = [{"role": "system", "content": SYSTEM}]
-
-    if memory:
-        for msg in memory:
-            role = "assistant" if msg["sender"] == "sana" else "user"
-            if role == "user" and msg["text"] == text:
-                continue
-            messages.append({"role": role, "content": msg["text"]})
-
-    messages.append({"role": "user", "content": text})
-    return messages
-
-
-if __name__ == "__main__":
-    print("Testing stream:")
-    for chunk in ask_llm_stream("Hello! Who are you?"):
-        print(chunk, end="", flush=True)
-    print()
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+from collections import deque
+from typing import Optional, List, Generator, Iterator
+import os
+import queue
+import threading
+import time
+
+load_dotenv()
+
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_MODEL = "llama-3.1-8b-instant"
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "10"))
+
+# Optional CPU-only fallback: path to a llama.cpp-compatible GGUF model.
+LOCAL_MODEL_PATH = os.getenv("LOCAL_LLM_MODEL")
+# Half the cores by default, leaving room for speech recognition and TTS.
+LOCAL_THREADS = int(os.getenv("LOCAL_LLM_THREADS", str(max(1, (os.cpu_count() or 4) // 2))))
+LOCAL_CONTEXT = 2048
+
+# Routing: when a backend has not produced its first token within the
+# deadline, the next one is started alongside it and the first token wins.
+# The last backend is never cut off. Hedging starts the two best at once;
+# with a CPU backend that costs a full local prompt prefill on every request.
+FIRST_TOKEN_DEADLINE = float(os.getenv("LLM_FIRST_TOKEN_DEADLINE", "2.5"))
+# Once a reply has started, give up if the next chunk takes longer than this.
+STREAM_STALL_TIMEOUT = float(os.getenv("LLM_STREAM_STALL_TIMEOUT", "10"))
+HEDGE_REQUESTS = os.getenv("LLM_HEDGE", "0").lower() in ("1", "true", "yes")
+LATENCY_WINDOW = 20
+LATENCY_MAX_AGE = 60.0  # Seconds before a sample stops counting, so demoted backends get retried
+MISS_PENALTY = 2.0  # Misses count as this many deadlines in the rolling average
+
+GENERATION = {
+    "temperature": 0.5,
+    "max_tokens": 160,  # Keep spoken replies concise
+    "top_p": 0.9,
+}
+
+SYSTEM = """
+You are Sana, a friendly and natural voice assistant.
+
+Style:
+- Speak clearly and casually, like a normal person.
+- Be polite, warm, and helpful.
+- Avoid sarcasm, teasing, roleplay, and dramatic expressions.
+- Keep responses short and easy to speak aloud.
+- Use simple words and short sentences when possible.
+
+Behavior:
+- Answer directly first, then add a brief follow-up question only if helpful.
+- If the user sounds emotional, respond gently.
+- Do not mention being an AI unless explicitly asked.
+
+Address the user as "karthick" when natural.
+"""
+
+
+class LLMBackend(ABC):
+    """Interface for a chat model that streams text chunks."""
+
+    name = "base"
+
+    @abstractmethod
+    def stream(self, messages: list, cancel: threading.Event) -> Iterator[str]:
+        """Yield reply chunks, stopping early once `cancel` is set."""
+
+    def available(self) -> bool:
+        """False while the backend is busy and would only queue the request."""
+        return True
+
+
+class GroqBackend(LLMBackend):
+    """Hosted Groq API."""
+
+    name = "groq"
+
+    def __init__(self, api_key: str, model: str = GROQ_MODEL, timeout: float = GROQ_TIMEOUT):
+        from groq import Groq
+
+        self.model = model
+        self.client = Groq(api_key=api_key, timeout=timeout, max_retries=0)
+
+    def stream(self, messages: list, cancel: threading.Event) -> Iterator[str]:
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            **GENERATION,
+        )
+        try:
+            for chunk in stream:
+                if cancel.is_set():
+                    return
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+
+
+class LocalBackend(LLMBackend):
+    """CPU-only llama.cpp model, loaded on first use."""
+
+    name = "local"
+
+    def __init__(self, model_path: str, n_threads: int = LOCAL_THREADS):
+        self.model_path = model_path
+        self.n_threads = n_threads
+        self._llm = None
+        # llama.cpp contexts are not thread-safe; one generation at a time.
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._llm is None:
+            from llama_cpp import Llama
+
+            self._llm = Llama(
+                model_path=self.model_path,
+                n_ctx=LOCAL_CONTEXT,
+                n_threads=self.n_threads,
+                n_gpu_layers=0,
+                verbose=False,
+            )
+        return self._llm
+
+    def warm_up(self) -> None:
+        """Load the model in the background so the first fallback is fast."""
+        def load():
+            try:
+                with self._lock:
+                    self._load()
+            except Exception as exc:
+                print(f"[LLM warning] Local model failed to load: {exc}")
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def available(self) -> bool:
+        return not self._lock.locked()
+
+    def stream(self, messages: list, cancel: threading.Event) -> Iterator[str]:
+        with self._lock:
+            stream = self._load().create_chat_completion(
+                messages=messages,
+                stream=True,
+                **GENERATION,
+            )
+            try:
+                for chunk in stream:
+                    # Checked per token, so a cancelled request frees the lock quickly.
+                    if cancel.is_set():
+                        return
+                    content = chunk["choices"][0]["delta"].get("content")
+                    if content:
+                        yield content
+            finally:
+                stream.close()
+
+
+class _LatencyStats:
+    """Rolling first-token latency for one backend."""
+
+    def __init__(self, window: int = LATENCY_WINDOW, max_age: float = LATENCY_MAX_AGE):
+        self.samples = deque(maxlen=window)
+        self.max_age = max_age
+
+    def record(self, seconds: float) -> None:
+        self.samples.append((time.monotonic(), seconds))
+
+    def average(self) -> Optional[float]:
+        cutoff = time.monotonic() - self.max_age
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        if not self.samples:
+            return None
+        return sum(seconds for _, seconds in self.samples) / len(self.samples)
+
+
+# Pump thread events
+_TOKEN, _DONE, _ERROR = "token", "done", "error"
+
+
+def _pump(backend: LLMBackend, messages: list, out: queue.Queue, cancel: threading.Event) -> None:
+    """Run a backend stream in a worker thread, forwarding chunks to a queue."""
+    gen = None
+    try:
+        gen = backend.stream(messages, cancel)
+        for chunk in gen:
+            if cancel.is_set():
+                return
+            out.put((backend, _TOKEN, chunk))
+    except Exception as exc:
+        out.put((backend, _ERROR, exc))
+        return
+    finally:
+        if gen is not None:
+            gen.close()
+    out.put((backend, _DONE, None))
+
+
+class LatencyRouter:
+    """Route requests to the backend with the best rolling first-token latency.
+
+    Backends are started in ranked order. Each time the running ones miss the
+    first-token deadline or fail, the next backend is started alongside them,
+    and whichever streams a token first wins. The last backend has no
+    deadline. With hedging enabled, the two best backends start together.
+    """
+
+    def __init__(
+        self,
+        backends: List[LLMBackend],
+        deadline: float = FIRST_TOKEN_DEADLINE,
+        hedge: bool = HEDGE_REQUESTS,
+        max_age: float = LATENCY_MAX_AGE,
+        stall_timeout: float = STREAM_STALL_TIMEOUT,
+    ):
+        if not backends:
+            raise ValueError("LatencyRouter needs at least one backend")
+        self.backends = backends
+        self.deadline = deadline
+        self.hedge = hedge
+        self.stall_timeout = stall_timeout
+        # Keyed by backend object: two backends of one class share a name.
+        self._stats = {backend: _LatencyStats(max_age=max_age) for backend in backends}
+        self._lock = threading.Lock()
+
+    def _record(self, backend: LLMBackend, seconds: float) -> None:
+        with self._lock:
+            self._stats[backend].record(seconds)
+
+    def _record_miss(self, backend: LLMBackend) -> None:
+        self._record(backend, self.deadline * MISS_PENALTY)
+
+    def ranked(self) -> List[LLMBackend]:
+        """Backends ordered by availability, then rolling latency.
+
+        Without recent history the primary backend is assumed fast and the
+        others are assumed to sit at the deadline, so configured order comes
+        back once a demoted primary's misses have aged out.
+        """
+        with self._lock:
+            def key(item):
+                index, backend = item
+                average = self._stats[backend].average()
+                if average is None:
+                    average = 0.0 if index == 0 else self.deadline
+                return (not backend.available(), average, index)
+
+            return [backend for _, backend in sorted(enumerate(self.backends), key=key)]
+
+    def stream(self, messages: list) -> Generator[str, None, None]:
+        waiting = self.ranked()
+        out = queue.Queue()
+        cancels = {}
+        started = {}
+        running = set()
+        missed = set()
+        winner = None
+        last_error = None
+
+        def launch():
+            backend = waiting.pop(0)
+            cancels[backend] = threading.Event()
+            started[backend] = time.monotonic()
+            running.add(backend)
+            threading.Thread(
+                target=_pump,
+                args=(backend, messages, out, cancels[backend]),
+                daemon=True,
+            ).start()
+            return started[backend] + self.deadline
+
+        try:
+            next_deadline = launch()
+            if self.hedge and waiting:
+                next_deadline = launch()
+
+            while winner is None and (running or waiting):
+                if not running:
+                    # Everything started so far failed; fail over immediately.
+                    next_deadline = launch()
+                    continue
+
+                timeout = None
+                if waiting:
+                    timeout = next_deadline - time.monotonic()
+                    if timeout <= 0:
+                        for backend in self.backends:
+                            if backend in running and backend not in missed:
+                                missed.add(backend)
+                                self._record_miss(backend)
+                                print(
+                                    f"[LLM warning] {backend.name} missed the "
+                                    f"{self.deadline:.1f}s first-token deadline"
+                                )
+                        next_deadline = launch()
+                        continue
+
+                try:
+                    backend, kind, payload = out.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+
+                if kind == _TOKEN:
+                    winner = backend
+                    self._record(backend, time.monotonic() - started[backend])
+                    for other, cancel in cancels.items():
+                        if other is not backend:
+                            cancel.set()
+                    yield payload
+                    continue
+
+                # Finished or failed without a token: not a usable answer.
+                running.discard(backend)
+                if backend not in missed:
+                    self._record_miss(backend)
+                if kind == _ERROR:
+                    last_error = f"{backend.name}: {payload}"
+                    print(f"[LLM warning] {backend.name} failed: {payload}")
+                else:
+                    last_error = f"{backend.name}: returned an empty reply"
+
+            if winner is None:
+                raise RuntimeError(f"All LLM backends failed: {last_error}")
+
+            # Stream the rest from the winner, dropping the losers' output.
+            # A stall or error here fails the reply rather than cutting it short.
+            chunk_deadline = time.monotonic() + self.stall_timeout
+            while True:
+                try:
+                    backend, kind, payload = out.get(timeout=max(0.0, chunk_deadline - time.monotonic()))
+                except queue.Empty:
+                    raise RuntimeError(
+                        f"{winner.name} stalled for {self.stall_timeout:.1f}s mid-reply"
+                    ) from None
+                if backend is not winner:
+                    continue
+                if kind == _TOKEN:
+                    yield payload
+                    chunk_deadline = time.monotonic() + self.stall_timeout
+                elif kind == _ERROR:
+                    raise RuntimeError(f"{winner.name} failed mid-reply: {payload}") from payload
+                else:
+                    return
+        finally:
+            for cancel in cancels.values():
+                cancel.set()
+
+
+def _build_backends() -> List[LLMBackend]:
+    backends = []
+    if GROQ_API_KEY:
+        backends.append(GroqBackend(GROQ_API_KEY))
+    if LOCAL_MODEL_PATH:
+        local = LocalBackend(LOCAL_MODEL_PATH)
+        local.warm_up()
+        backends.append(local)
+    return backends
+
+
+_backends = _build_backends()
+router = LatencyRouter(_backends) if _backends else None
+
+
+def ask_llm(text: str, memory: Optional[List] = None) -> str:
+    """Non-streaming version for compatibility."""
+    return "".join(ask_llm_stream(text, memory))
+
+
+def ask_llm_stream(text: str, memory: Optional[List] = None) -> Generator[str, None, None]:
+    """Streaming version - yields text chunks as they arrive."""
+    if router is None:
+        raise ValueError(
+            "Please set GROQ_API_KEY or LOCAL_LLM_MODEL (path to a GGUF model) in .env file"
+        )
+    messages = _build_messages(text, memory)
+    yield from router.stream(messages)
+
+
+def _build_messages(text: str, memory: Optional[List] = None) -> list:
+    """Build message array for API call."""
+    messages = [{"role": "system", "content": SYSTEM}]
+
+    if memory:
+        for msg in memory:
+            role = "assistant" if msg["sender"] == "sana" else "user"
+            if role == "user" and msg["text"] == text:
+                continue
+            messages.append({"role": role, "content": msg["text"]})
+
+    messages.append({"role": "user", "content": text})
+    return messages
+
+
+if __name__ == "__main__":
+    print("Testing stream:")
+    for chunk in ask_llm_stream("Hello! Who are you?"):
+        print(chunk, end="", flush=True)
+    print()
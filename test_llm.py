@@ -0,0 +1,199 @@
+"""Routing checks for llm.py, run with pytest.
+
+Fake backends and fake model objects keep these fast and offline. Set
+LLM_TEST_GGUF to a small GGUF model to also exercise llama.cpp for real.
+"""
+import inspect
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from llm import GENERATION, GroqBackend, LatencyRouter, LLMBackend, LocalBackend
+
+
+class FakeBackend(LLMBackend):
+    """Waits `delay` seconds, then fails or streams a short reply."""
+
+    def __init__(self, name, delay=0.0, error=None, stall_after=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.stall_after = stall_after
+        self.cancelled = threading.Event()
+
+    def stream(self, messages, cancel):
+        if cancel.wait(self.delay):
+            self.cancelled.set()
+            return
+        if self.error and self.stall_after is None:
+            raise self.error
+        for count, word in enumerate(("hi", " there", " again")):
+            if count == self.stall_after:
+                if self.error:
+                    raise self.error
+                cancel.wait(5)
+                return
+            yield f"{self.name}:{word}"
+
+
+def reply_from(router):
+    return "".join(router.stream([])).split(":")[0]
+
+
+def test_backend_without_stream_cannot_be_created():
+    class Incomplete(LLMBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_deadline_failover_cancels_slow_primary():
+    slow, fast = FakeBackend("slow", delay=1.0), FakeBackend("fast", delay=0.05)
+    router = LatencyRouter([slow, fast], deadline=0.2)
+    assert reply_from(router) == "fast"
+    assert slow.cancelled.wait(1.0)
+
+
+def test_error_failover_never_cuts_off_last_backend():
+    down = FakeBackend("groq", error=ConnectionError("down"))
+    router = LatencyRouter([down, FakeBackend("local", delay=0.5)], deadline=0.2)
+    assert reply_from(router) == "local"
+
+
+def test_hedged_race_takes_first_token_and_cancels_loser():
+    slow, fast = FakeBackend("slow", delay=0.3), FakeBackend("fast", delay=0.05)
+    router = LatencyRouter([slow, fast], deadline=0.2, hedge=True)
+    assert reply_from(router) == "fast"
+    assert slow.cancelled.wait(1.0)
+
+
+def test_hedged_race_where_both_fail_reports_cause():
+    router = LatencyRouter(
+        [FakeBackend("a", error=ValueError("bad key")), FakeBackend("b", error=ConnectionError("down"))],
+        deadline=0.2,
+        hedge=True,
+    )
+    with pytest.raises(RuntimeError, match="bad key|down"):
+        list(router.stream([]))
+
+
+def test_demoted_primary_recovers_after_misses_age_out():
+    primary = FakeBackend("groq", error=ConnectionError("down"))
+    router = LatencyRouter([primary, FakeBackend("local")], deadline=0.2, max_age=0.3)
+    for _ in range(8):
+        assert reply_from(router) == "local"
+    assert [backend.name for backend in router.ranked()] == ["local", "groq"]
+
+    primary.error = None
+    time.sleep(0.4)
+    assert reply_from(router) == "groq"
+
+
+def test_backends_sharing_a_name_are_tracked_separately():
+    slow, fast = FakeBackend("local", delay=1.0), FakeBackend("local", delay=0.05)
+    router = LatencyRouter([slow, fast], deadline=0.2)
+    assert "".join(router.stream([])) == "local:hilocal: therelocal: again"
+    assert slow.cancelled.wait(1.0)
+    assert router.ranked() == [fast, slow]
+
+
+def test_stall_mid_reply_fails_instead_of_truncating():
+    router = LatencyRouter([FakeBackend("local", stall_after=1)], stall_timeout=0.2)
+    with pytest.raises(RuntimeError, match="stalled"):
+        list(router.stream([]))
+
+
+def test_error_mid_reply_fails_instead_of_truncating():
+    backend = FakeBackend("groq", error=ConnectionError("reset"), stall_after=1)
+    router = LatencyRouter([backend])
+    with pytest.raises(RuntimeError, match="reset"):
+        list(router.stream([]))
+
+
+class FakeLlama:
+    """Stands in for llama_cpp.Llama, with the same create_chat_completion keywords."""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def create_chat_completion(self, messages, stream, temperature, max_tokens, top_p):
+        def chunks():
+            try:
+                for _ in range(max_tokens):
+                    time.sleep(0.02)
+                    yield {"choices": [{"delta": {"content": "word "}}]}
+            finally:
+                self.closed.set()
+
+        return chunks()
+
+
+def test_local_backend_releases_lock_soon_after_cancel():
+    backend = LocalBackend("unused.gguf")
+    backend._llm = FakeLlama()
+    router = LatencyRouter([backend, FakeBackend("groq", delay=0.3)], hedge=True)
+
+    # Local wins this race; stop reading after the first chunk.
+    reply = router.stream([])
+    assert next(reply) == "word "
+    reply.close()
+
+    assert backend._llm.closed.wait(0.5)
+    deadline = time.monotonic() + 0.5
+    while not backend.available() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert backend.available()
+
+
+def test_groq_backend_closes_stream_on_cancel():
+    closed = threading.Event()
+    cancel = threading.Event()
+
+    def create(**kwargs):
+        def chunks():
+            try:
+                while True:
+                    delta = SimpleNamespace(content="word ")
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+            finally:
+                closed.set()
+
+        return chunks()
+
+    backend = GroqBackend.__new__(GroqBackend)
+    backend.model = "test"
+    backend.client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+    )
+    stream = backend.stream([], cancel)
+    assert next(stream) == "word "
+    cancel.set()
+    assert list(stream) == []
+    assert closed.is_set()
+
+
+def test_local_backend_matches_llama_cpp_signature():
+    llama_cpp = pytest.importorskip("llama_cpp")
+    params = inspect.signature(llama_cpp.Llama.create_chat_completion).parameters
+    for keyword in ("messages", "stream", *GENERATION):
+        assert keyword in params
+
+
+@pytest.mark.skipif(not os.getenv("LLM_TEST_GGUF"), reason="set LLM_TEST_GGUF to a small GGUF model")
+def test_local_backend_with_real_model():
+    backend = LocalBackend(os.environ["LLM_TEST_GGUF"], n_threads=2)
+    cancel = threading.Event()
+    messages = [{"role": "user", "content": "Say hello."}]
+
+    stream = backend.stream(messages, cancel)
+    assert next(stream)
+    cancel.set()
+    list(stream)
+    assert backend.available()
+
+    cancel = threading.Event()
+    assert "".join(backend.stream(messages, cancel)).strip()